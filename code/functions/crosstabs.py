@@ -1,21 +1,85 @@
+import functools
 import re
 
+# Patterns
+# from $$) as ... ( ... )
+_OUTPUT_COLS = re.compile(r'\)\s*as\s+(?:\w+\s*)?\(\s*(.*?)\s*\)', re.IGNORECASE | re.DOTALL)
+# between SELECT and FROM
+_SELECT_FROM = re.compile(r'SELECT(.*?)FROM', re.IGNORECASE | re.DOTALL)
+# between FROM and ORDER
+_FROM_ORDER = re.compile(r'FROM(.*?)ORDER', re.IGNORECASE | re.DOTALL)
+# table names after FROM/JOIN (skipping LATERAL, schema.table, function calls and casts)
+_JOIN_TABLE = re.compile(r'\b(FROM|JOIN(?!\s+LATERAL)|LEFT\s+JOIN(?!\s+LATERAL)|RIGHT\s+JOIN(?!\s+LATERAL)|INNER\s+JOIN(?!\s+LATERAL)|OUTER\s+JOIN(?!\s+LATERAL)|FULL\s+JOIN(?!\s+LATERAL)|CROSS\s+JOIN(?!\s+LATERAL))\s+([a-zA-Z_][\w]*)\b(?!\s*\.|\s*\(|::)', re.IGNORECASE | re.DOTALL)
+# Ten behoeve van het WITH statement
+_WITH_BLOCK = re.compile(r'(WITH\s+.*\))\s*(?=SELECT|FROM|$)', re.IGNORECASE | re.DOTALL)
+# column alias separator
+_AS_ALIAS = re.compile(r'\s+as\s+', re.IGNORECASE)
+# brackets and commas, the only characters that matter when splitting a SELECT list
+_SPLIT_SCAN = re.compile(r'[()\[\],]')
+# dbt_utils.pivot call that replaces the crosstab() columns
+_PIVOT_TEMPLATE = (
+    "{{{{ dbt_utils.pivot('{pivot_col}',"
+    "        dbt_utils.get_column_values(ref('{input_model}'),'categorie',default=[]),"
+    "        agg='',"
+    "        then_value='{value_col}',"
+    "        else_value=\"ARRAY_CONSTRUCT()\","
+    "        quote_identifiers=False)}}}} "
+)
+
+def _split_top_level_columns(select_statement: str) -> list:
+    """Split a SELECT column list on commas that are not nested inside () or []."""
+    # Without brackets every comma is a top-level comma, so str.split does all the work
+    if not any(char in select_statement for char in '()[]'):
+        select_cols = [col.strip() for col in select_statement.split(',')]
+        if not select_cols[-1]:
+            select_cols.pop()
+        return select_cols
+    select_cols = []
+    parent_count = 0
+    start = 0
+    for match in _SPLIT_SCAN.finditer(select_statement):
+        char = match.group()
+        if char == '(' or char == '[':
+            parent_count += 1
+        elif char == ')' or char == ']':
+            parent_count -= 1
+        elif parent_count == 0:
+            select_cols.append(select_statement[start:match.start()].strip())
+            start = match.end()
+    # Add the last column
+    last_col = select_statement[start:].strip()
+    if last_col:
+        select_cols.append(last_col)
+    return select_cols
+
+def _find_dollar_blocks(sql_content: str):
+    """Yield everything within each $$...$$ pair."""
+    pos = 0
+    while True:
+        start = sql_content.find('$$', pos)
+        if start < 0:
+            return
+        end = sql_content.find('$$', start + 2)
+        if end < 0:
+            return
+        yield sql_content[start + 2:end]
+        pos = end + 2
+
+def _ref_table(match) -> str:
+    """Wrap the table name of a _JOIN_TABLE match in a dbt ref(), keeping the FROM/JOIN part as is."""
+    table = match.group(2)
+    return match.group(0)[:-len(table)] + "{{ ref('" + table + "') }}"
+
+@functools.lru_cache(maxsize=1024)
 def parse_crosstab_sql(sql_content: str):
     """
     Parse a crosstab SQL block and extract pivot information and output columns.
     Returns a dict with keys: 'pivot_col', 'from_statements', 'output_cols', 'cte_select_statement', 'pivot_statement', 'cte_statement'.
     Raises ValueError if unsupported patterns are found.
+    Results are cached per sql_content; use parse_crosstab_sql.cache_clear() to reset.
     """
-    # Patterns
-    pattern_1 = r'\$\$(.*?)\$\$'        # everything within $$...$$
-    pattern_2 = r'\)\s*as\s+(?:\w+\s*)?\(\s*(.*?)\s*\)' # from $$) as ... ( ... )
-    pattern_3 = r'SELECT(.*?)FROM'      # between SELECT and FROM
-    pattern_4 = r'FROM(.*?)ORDER'       # between FROM and ORDER
-    pattern_5 = r'\b(FROM|JOIN(?!\s+LATERAL)|LEFT\s+JOIN(?!\s+LATERAL)|RIGHT\s+JOIN(?!\s+LATERAL)|INNER\s+JOIN(?!\s+LATERAL)|OUTER\s+JOIN(?!\s+LATERAL)|FULL\s+JOIN(?!\s+LATERAL)|CROSS\s+JOIN(?!\s+LATERAL))\s+([a-zA-Z_][\w]*)\b(?!\s*\.|\s*\(|::)'
-    pattern_6 = r'(WITH\s+.*\))\s*(?=SELECT|FROM|$)' # Ten behoeve van het WITH statement 
-
     # Extract statements
-    statements = re.findall(pattern_1, sql_content, re.DOTALL)
+    statements = list(_find_dollar_blocks(sql_content))
     if len(statements) < 2:
             return ''
     cte_statement = statements[0]
@@ -27,13 +91,13 @@ def parse_crosstab_sql(sql_content: str):
             return ''
 
     # Extract pivot column and from statements safely
-    m_pivot_col = re.search(pattern_3, pivot_statement, re.IGNORECASE | re.DOTALL)
+    m_pivot_col = _SELECT_FROM.search(pivot_statement)
     if not m_pivot_col:
         return ''
     
     # Find WITH statement if present within the CROSSTAB satement
     # If so, split the statement between the WITH-block and the SELECT-block
-    m_with_match = re.search(pattern_6, cte_statement, re.IGNORECASE | re.DOTALL)
+    m_with_match = _WITH_BLOCK.search(cte_statement)
     if m_with_match:
         with_statement = m_with_match.group(1)
         # Remove the WITH block from cte_statement to get just the SELECT part
@@ -42,22 +106,13 @@ def parse_crosstab_sql(sql_content: str):
         with_statement = None
 
     pivot_col = m_pivot_col.group(1).strip()
-    m_from_statements = re.search(pattern_4, pivot_statement, re.IGNORECASE | re.DOTALL)
+    m_from_statements = _FROM_ORDER.search(pivot_statement)
     if not m_from_statements:
         return ''
     from_statements = m_from_statements.group(1).strip()
 
-    # Build dbt_utils.get_column_values statement (example)
-    str_dbt_get_column_values = "{{ dbt_utils.pivot('<pivot_col>',\
-        dbt_utils.get_column_values(ref('<input_model>'),'categorie',default=[]),\
-        agg='',\
-        then_value='<value_col>',\
-        else_value=\"ARRAY_CONSTRUCT()\",\
-        quote_identifiers=False)}} ".replace('<pivot_col>', pivot_col).replace('<input_model>', from_statements)
-    # print("dbt utils get column values statement:\n", str_dbt_get_column_values)    
-
     ## Bepaal welke kolommen meegaan in de output
-    m_statement_as = re.search(pattern_2, sql_content, re.IGNORECASE | re.DOTALL)
+    m_statement_as = _OUTPUT_COLS.search(sql_content)
     if not m_statement_as:
         return ''
     statement_as = m_statement_as.group(1).strip().replace('(','').replace(';','').strip()
@@ -68,73 +123,52 @@ def parse_crosstab_sql(sql_content: str):
     # print('Output columns: ', output_cols)
 
     ## Selecteer de kolom-statements uit de cte_statement
-    m_cte_select_statement = re.search(pattern_3, cte_statement, re.IGNORECASE | re.DOTALL)
+    m_cte_select_statement = _SELECT_FROM.search(cte_statement)
     if not m_cte_select_statement:
         return ''
     cte_select_statement = m_cte_select_statement.group(1).strip()
     # print('Select columns: ', cte_select_statement)
-    select_cols = []
-    parent_count = 0
-    current_col = ''
-    for char in cte_select_statement:
-        if char == '(' or char == '[':
-            parent_count += 1
-        elif char == ')' or char == ']':
-            parent_count -= 1
-        elif (char == ',') and parent_count == 0:
-            current_col = current_col.strip()
-            
-            select_cols.append(current_col)
-            current_col = ""
-            continue
-        current_col += char
-    # Add the last column
-    if current_col.strip():
-        select_cols.append(current_col.strip())
+    select_cols = _split_top_level_columns(cte_select_statement)
     # print('Select columns parsed: ', select_cols)
 
     input_cols = []
     for item in select_cols:
-        if re.search(r'\s+as\s+', item, re.IGNORECASE):
+        if _AS_ALIAS.search(item):
             # Kolom heeft een alias
-            col_name = re.split(r'\s+as\s+', item, flags=re.IGNORECASE)[1].strip()
+            col_name = _AS_ALIAS.split(item)[1].strip()
         else:
             # Geen alias, neem de originele kolomnaam
             col_name = item.strip().split(' ')[0]
         input_cols.append(col_name)
 
+    # Kolommen in volgorde van de cte_statement (dict.fromkeys ontdubbelt zonder de volgorde te verliezen)
+    output_set = set(output_cols)
     #Kolommen voor de pivot:
-    cols_to_pivot = list(set(input_cols) - set(output_cols))
+    cols_to_pivot = list(dict.fromkeys(col for col in input_cols if col not in output_set))
     # print("Categorie naar kolom: ", cols_to_pivot[0])
     # print("Waarden in kolom: ", cols_to_pivot[1])
-    str_dbt_get_column_values = str_dbt_get_column_values.replace('<value_col>', cols_to_pivot[1])
-    # print("Aangepaste dbt utils get column values statement:\n", str_dbt_get_column_values)
+    # Build dbt_utils.get_column_values statement
+    str_dbt_get_column_values = _PIVOT_TEMPLATE.format(
+        pivot_col=pivot_col,
+        input_model=from_statements,
+        value_col=cols_to_pivot[1]
+    )
     #Kolommen voor de select en group by:
-    cols_to_select = list(set(input_cols) & set(output_cols))
-    select_col = ''
-    for idx, col in enumerate(cols_to_select):
-        if idx == len(cols_to_select) - 1:
-            select_col += col
-        else:
-            select_col += col + ', '
-
-    table = re.findall(pattern_5, cte_statement, re.IGNORECASE | re.DOTALL)
+    cols_to_select = list(dict.fromkeys(col for col in input_cols if col in output_set))
+    select_col = ', '.join(cols_to_select)
 
     if with_statement:
         cte_statement = with_statement + "\n ,cte1 AS (\n" + cte_statement + "\n)\n"
     else: 
-        for t in table:
-            cte_statement = cte_statement.replace(t[1], "{{ ref('" + t[1] + "') }}")
+        cte_statement = _JOIN_TABLE.sub(_ref_table, cte_statement)
         cte_statement= "WITH cte1 AS (\n" + cte_statement + ")\n"
 
-    # Remove trailing comma and space from select_col and group by
-    select_col_clean = select_col.rstrip(', ').strip()
     # Build the actual dbt crosstab SQL statement
     dbt_sql = (
         f"{cte_statement}"
-        f"SELECT {select_col_clean}\n"
+        f"SELECT {select_col}\n"
         f", {str_dbt_get_column_values}\n"
         f"FROM cte1\n"
-        f"GROUP BY {select_col_clean}"
+        f"GROUP BY {select_col}"
     )
     return dbt_sql
\ No newline at end of file
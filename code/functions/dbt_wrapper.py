@@ -1,3 +1,4 @@
+import functools
 from pathlib import Path
 from typing import Any, Dict
 import re
@@ -5,6 +6,38 @@ from code.functions.dialect_converter import convert_postgres_to_snowflake
 from code.functions.general import *
 import traceback
 
+# Table/view names created by a block ("name AS (")
+_CREATED_TABLE = re.compile(r'\b(\w+)\s+AS\s*\(', re.IGNORECASE)
+# dbt macro calls like {{ blockname() }}
+_MACRO = re.compile(r"({{\s*[\w_]+\(\)\s*}})")
+_MACRO_PLACEHOLDER = re.compile(r'__DBT_MACRO_(\d+)__')
+# SQL comments to rewrite as Jinja comments: /*, */ (unless its '/' opens a new /*) or -- ...
+_COMMENT_REWRITE = re.compile(r'(/\*)|(\*/)(?!\*)|--([^\n]*)')
+_CREATE_VIEW = re.compile(r'CREATE\s+(?:MATERIALIZED\s+)?VIEW\s+\w+\s+AS\s*', re.IGNORECASE)
+_WITH_OR_SELECT = re.compile(r'^(WITH|SELECT)', re.IGNORECASE)
+# External variables like ${varname}, optionally quoted
+_VAR = re.compile(r'\$\{([a-zA-Z_][\w]*)\}')
+_VAR_ANY = re.compile(r"(['\"])\$\{([a-zA-Z_][\w]*)\}\1|\$\{([a-zA-Z_][\w]*)\}")
+# Comments (both SQL and Jinja), removed before CTE detection
+_LINE_COMMENT = re.compile(r'--[^\n]*')
+_BLOCK_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_JINJA_COMMENT = re.compile(r'\{#.*?#\}', re.DOTALL)
+# Potential CTE definitions: word followed by AS (optionally with any number of extra words like MATERIALIZED)
+_CTE = re.compile(r'\b(\w+)\s*(?:\([^)]+\))?\s+AS(?:\s+\w+)*\s*\(', re.IGNORECASE)
+# FROM or any JOIN type, but skip if immediately followed by LATERAL (e.g., JOIN LATERAL, LEFT JOIN LATERAL, etc.)
+# Only match if the table name is not followed by a dot (schema/table or table.column),
+# not followed by an open parenthesis (function call),
+# and not immediately followed by '::' (type cast)
+_TABLE_REFERENCE = re.compile(r'\b(FROM|JOIN(?!\s+LATERAL)|LEFT\s+JOIN(?!\s+LATERAL)|RIGHT\s+JOIN(?!\s+LATERAL)|INNER\s+JOIN(?!\s+LATERAL)|OUTER\s+JOIN(?!\s+LATERAL)|FULL\s+JOIN(?!\s+LATERAL)|CROSS\s+JOIN(?!\s+LATERAL))\s+([a-zA-Z_][\w]*)\b(?!\s*\.|\s*\(|::)', re.IGNORECASE)
+# Source tables that live in the STG.P{{praktijk_agb}} schema instead of being dbt models
+_DEFAULT_EXTERNAL_TABLES = frozenset({
+    'allergie', 'bepaling', 'contact', 'contraindicatie', 'episode', 'journaal',
+    'journaalregel', 'medewerker', 'medicatie', 'metadata', 'origineel',
+    'patient', 'praktijk', 'ruiter', 'verrichting', 'verwijzing', 'override_patientenlijst', 'functie', 'medewerker_hisnaam'
+})
+# SQL keywords that can look like a table/CTE name in the "name AS (" patterns
+_SQL_KEYWORDS = frozenset({'select', 'insert', 'update', 'delete', 'with', 'case'})
+
 def convert_pry_to_dbt(pry_path: Path, output_dir: Path, config, block_tables=None) -> set:
     """Convert PRY file to dbt models.
     
@@ -16,7 +49,7 @@ def convert_pry_to_dbt(pry_path: Path, output_dir: Path, config, block_tables=No
     content = pry_path.read_text(encoding='utf-8')
 
     # If PRY is in a blocks folder (case-insensitive, anywhere in path), process as block
-    if any(p.name.lower() == 'blocks' for p in pry_path.parents):
+    if is_block_file(pry_path):
         block_name = pry_path.stem
         
         preprocessed = preprocess_sql(content)
@@ -24,9 +57,9 @@ def convert_pry_to_dbt(pry_path: Path, output_dir: Path, config, block_tables=No
         
         # Extract all table/view names created by this block (look for "name AS (")
         created_tables = set()
-        for match in re.finditer(r'\b(\w+)\s+AS\s*\(', converted_sql, re.IGNORECASE):
+        for match in _CREATED_TABLE.finditer(converted_sql):
             table_name = match.group(1).lower()
-            if table_name not in ['select', 'insert', 'update', 'delete', 'with', 'case']:
+            if table_name not in _SQL_KEYWORDS:
                 created_tables.add(table_name)
         
         # All blocks become macros
@@ -56,8 +89,7 @@ def convert_pry_to_dbt(pry_path: Path, output_dir: Path, config, block_tables=No
         full_output_dir = output_dir / folder_name
         full_output_dir.mkdir(parents=True, exist_ok=True)
         for i, query in enumerate(queries):
-            # Replace any {% include 'blockname.pry' %} with {{ blockname() }} even if it's part of a line
-            query = re.sub(r"{%-?\s*include\s+['\"]([\w\-]+)\.pry['\"]\s*%}", r"{{ \1() }}", query)
+            # {% include 'blockname.pry' %} is rewritten to {{ blockname() }} by preprocess_sql in generate_dbt_model
             view_name = extract_view_name_from_query(query)
             if not view_name:
                 print(f"Warning: Could not extract view name from query {i+1}")
@@ -77,6 +109,17 @@ def convert_pry_to_dbt(pry_path: Path, output_dir: Path, config, block_tables=No
             )
         return set()
 
+def _comment_to_jinja(match) -> str:
+    """Rewrite a single SQL comment marker matched by _COMMENT_REWRITE as Jinja."""
+    # Multi-line comments: /* ... */  ->  {# ... #}
+    if match.group(1):
+        return '{#'
+    if match.group(2):
+        return '#}'
+    # Single-line comments: -- ...  ->  {# ... #}
+    text = match.group(3).replace('/*', '{#').replace('*/', '#}')
+    return '{# ' + text + ' #}'
+
 def generate_dbt_model(
     view_name: str,
     query: str,
@@ -96,39 +139,34 @@ def generate_dbt_model(
         # Preprocess SQL (handles comment conversion and includes)
         preprocessed = preprocess_sql(query)
         # Preserve dbt macro calls by replacing them with placeholders
-        macro_pattern = r"({{\s*[\w_]+\(\)\s*}})"
         macros = []
         def macro_replacer(match):
             macros.append(match.group(1))
             return f"__DBT_MACRO_{len(macros)-1}__"
-        temp_sql = re.sub(macro_pattern, macro_replacer, preprocessed)
+        temp_sql = _MACRO.sub(macro_replacer, preprocessed)
         # Convert SQL from PostgreSQL to Snowflake
         converted_sql = convert_postgres_to_snowflake(temp_sql)
-        # Restore macro calls
-        for idx, macro in enumerate(macros):
-            converted_sql = converted_sql.replace(f"__DBT_MACRO_{idx}__", macro)
+        # Restore macro calls in one pass
+        if macros:
+            converted_sql = _MACRO_PLACEHOLDER.sub(
+                lambda m: macros[int(m.group(1))] if int(m.group(1)) < len(macros) else m.group(0),
+                converted_sql
+            )
         # Replace all SQL comments with Jinja comments (after SQL conversion)
-        # Multi-line comments: /* ... */  ->  {# ... #}
-        converted_sql = re.sub(r'/\*', r'{#', converted_sql)
-        converted_sql = re.sub(r'\*/', r'#}', converted_sql)
-        # Single-line comments: -- ...  ->  {# ... #}
-        converted_sql = re.sub(r'--([^\n]*)', r'{# \1 #}', converted_sql)
+        converted_sql = _COMMENT_REWRITE.sub(_comment_to_jinja, converted_sql)
         # Check if actually converted
         if converted_sql == preprocessed:
             print("[WARNING] SQL was not modified during conversion")
         # Remove CREATE [MATERIALIZED] VIEW statement, keep only the SELECT/WITH
-        converted_sql = re.sub(
-            r'CREATE\s+(MATERIALIZED\s+)?VIEW\s+\w+\s+AS\s*',
-            '',
-            converted_sql,
-            count=1,
-            flags=re.IGNORECASE
-        )
+        # (it is normally at the very start, so try an anchored match before searching the whole SQL)
+        create_view = _CREATE_VIEW.match(converted_sql) or _CREATE_VIEW.search(converted_sql)
+        if create_view:
+            converted_sql = converted_sql[:create_view.start()] + converted_sql[create_view.end():]
         # Replace table references with dbt macros
         converted_sql = replace_table_references(converted_sql, block_tables=block_tables)
         # Ensure it starts with WITH or SELECT
         converted_sql = converted_sql.strip()
-        if not re.match(r'^(WITH|SELECT)', converted_sql, re.IGNORECASE):
+        if not _WITH_OR_SELECT.match(converted_sql):
             print(f"[WARNING] Query doesn't start with WITH or SELECT after removing CREATE VIEW")
             print(f"First 100 chars: {converted_sql[:100]}")
         # Build dbt variable section using {% set %}
@@ -139,16 +177,14 @@ def generate_dbt_model(
             "{%- set praktijk_agb = var(\"praktijk_agb\", none) %}",
         ]
         # Extract all external variables like ${varname} in the SQL
-        external_vars = set(re.findall(r'\$\{([a-zA-Z_][\w]*)\}', converted_sql))
+        external_vars = set(_VAR.findall(converted_sql))
         # Exclude praktijk_agb (already set)
         external_vars.discard('praktijk_agb')
         # Add each as a dbt variable
         for var in sorted(external_vars):
             variables.append(f"{{%- set {var} = var(\"{var}\", none) %}}")
-        # First replace quoted '${varname}' or "${varname}" with unquoted dbt variable
-        converted_sql = re.sub(r"(['\"])\$\{([a-zA-Z_][\w]*)\}\1", lambda m: f"{{{{ var('{m.group(2)}', none) }}}}", converted_sql)
-        # Then replace any remaining unquoted ${varname}
-        converted_sql = re.sub(r'\$\{([a-zA-Z_][\w]*)\}', lambda m: f"{{{{ var('{m.group(1)}', none) }}}}", converted_sql)
+        # Replace quoted '${varname}' or "${varname}" and unquoted ${varname} with unquoted dbt variable
+        converted_sql = _VAR_ANY.sub(lambda m: f"{{{{ var('{m.group(2) or m.group(3)}', none) }}}}", converted_sql)
         if 'type' in view_metadata:
             variables.append("{%- set view_type = '" + view_metadata['type'] + "' %}")
         if 'displayname' in view_metadata:
@@ -171,10 +207,8 @@ def generate_dbt_model(
             "  )",
             "}}"
         ])
-        # Combine everything
-        model_content = '\n'.join(variables) + '\n\n'
-        model_content += '\n'.join(config_lines) + '\n\n'
-        model_content += converted_sql
+        # Combine everything in one join
+        model_content = '\n\n'.join(['\n'.join(variables), '\n'.join(config_lines), converted_sql])
         # Write to file
         output_file = output_dir / f"{view_name}.sql"
         output_file.write_text(model_content, encoding='utf-8')
@@ -196,33 +230,28 @@ def replace_table_references(sql: str, external_tables=None, block_tables=None)
     if block_tables is None:
         block_tables = set()
     if external_tables is None:
-        external_tables = [
-            'allergie', 'bepaling', 'contact', 'contraindicatie', 'episode', 'journaal',
-            'journaalregel', 'medewerker', 'medicatie', 'metadata', 'origineel',
-            'patient', 'praktijk', 'ruiter', 'verrichting', 'verwijzing', 'override_patientenlijst', 'functie', 'medewerker_hisnaam'
-        ]
-    
+        external_tables = _DEFAULT_EXTERNAL_TABLES
+    else:
+        external_tables = frozenset(t.lower() for t in external_tables)
+    return _replace_table_references(sql, external_tables, frozenset(block_tables))
+
+
+@functools.lru_cache(maxsize=1024)
+def _replace_table_references(sql: str, external_tables: frozenset, block_tables: frozenset) -> str:
+    """Cached implementation of replace_table_references (external_tables must be lowercase)."""
     # Robustly extract all CTE names from the entire SQL (not just top-level WITH)
     cte_names = set()
     # Temporarily remove comments (both SQL and Jinja) to avoid false matches in CTE detection only
-    sql_no_comments = re.sub(r'--[^\n]*', '', sql)
-    sql_no_comments = re.sub(r'/\*.*?\*/', '', sql_no_comments, flags=re.DOTALL)
-    sql_no_comments = re.sub(r'\{#.*?#\}', '', sql_no_comments, flags=re.DOTALL)
-    # Find all potential CTE definitions: word followed by AS (optionally with any number of extra words like MATERIALIZED)
-    for match in re.finditer(r'\b(\w+)\s*(?:\([^)]+\))?\s+AS(?:\s+\w+)*\s*\(', sql_no_comments, re.IGNORECASE):
+    sql_no_comments = _LINE_COMMENT.sub('', sql)
+    sql_no_comments = _BLOCK_COMMENT.sub('', sql_no_comments)
+    sql_no_comments = _JINJA_COMMENT.sub('', sql_no_comments)
+    # Find all potential CTE definitions
+    for match in _CTE.finditer(sql_no_comments):
         potential_cte = match.group(1).lower()
         # Exclude SQL keywords that might match this pattern
-        if potential_cte not in ['select', 'insert', 'update', 'delete', 'with', 'case']:
+        if potential_cte not in _SQL_KEYWORDS:
             cte_names.add(potential_cte)
-    
-    # Note: We only removed comments for CTE detection, the original SQL with comments is preserved
-    
-    # Regex to match FROM or any JOIN type, but skip if immediately followed by LATERAL (e.g., JOIN LATERAL, LEFT JOIN LATERAL, etc.)
-    # Only match if the table name is not followed by a dot (schema/table or table.column),
-    # not followed by an open parenthesis (function call),
-    # and not immediately followed by '::' (type cast)
-    pattern = r'\b(FROM|JOIN(?!\s+LATERAL)|LEFT\s+JOIN(?!\s+LATERAL)|RIGHT\s+JOIN(?!\s+LATERAL)|INNER\s+JOIN(?!\s+LATERAL)|OUTER\s+JOIN(?!\s+LATERAL)|FULL\s+JOIN(?!\s+LATERAL)|CROSS\s+JOIN(?!\s+LATERAL))\s+([a-zA-Z_][\w]*)\b(?!\s*\.|\s*\(|::)'
-    
+
     def replacer(match):
         keyword = match.group(1)
         table = match.group(2)
@@ -248,10 +277,10 @@ def replace_table_references(sql: str, external_tables=None, block_tables=None)
             return match.group(0)
 
         # Use correct dbt macro syntax with double curly brackets
-        if table.lower() in [t.lower() for t in external_tables]:
+        if table.lower() in external_tables:
             replacement = f"{keyword} STG.P{{{{praktijk_agb}}}}.{table}"
         else:
             replacement = f"{keyword} {{{{ ref('{table}') }}}}"
         return replacement
     
-    return re.sub(pattern, replacer, sql, flags=re.IGNORECASE)
\ No newline at end of file
+    return _TABLE_REFERENCE.sub(replacer, sql)
\ No newline at end of file
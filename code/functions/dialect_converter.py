@@ -1,12 +1,54 @@
+import functools
+import os
 import sys
 import re
+import re2
 import sqlglot
 from sqlglot import exp
+from sqlglot.errors import ParseError
 from sqlglot.dialects.snowflake import Snowflake
 
 from code.functions.crosstabs import parse_crosstab_sql
 
 
+# re2 matches \w, \s and \d on ASCII only, re on all of Unicode
+_RE2_UNICODE_CLASSES = {
+    r'\w': r'[\p{L}\p{N}_]',
+    r'\s': r'[\s\v\x1c-\x1f\x85\p{Z}]',
+    r'\d': r'\p{Nd}',
+}
+_RE2_CLASS_ESCAPE = re.compile(r'\\[wsd]')
+
+
+def _compile_linear(pattern: str, flags: int = 0):
+    """Compile pattern with google-re2 (linear time, no catastrophic backtracking), matching like re.
+
+    \w, \s and \d are translated to their Unicode classes, so they must not be used inside [...].
+    """
+    pattern = _RE2_CLASS_ESCAPE.sub(lambda match: _RE2_UNICODE_CLASSES[match.group(0)], pattern)
+    # The re2 module takes inline flags instead of re flags
+    inline = ('i' if flags & re.IGNORECASE else '') + ('s' if flags & re.DOTALL else '')
+    return re2.compile(f"(?{inline}){pattern}" if inline else pattern)
+
+
+# Set PRY_DEBUG to print the SQL before and after crosstab conversion
+_DEBUG = bool(os.environ.get('PRY_DEBUG'))
+
+# INTERVAL steps like INTERVAL '1 month'
+_INTERVAL = _compile_linear(r"INTERVAL\s+'(\d+)\s+(\w+)'", re.IGNORECASE)
+# SELECT unnest(ARRAY[...]) col
+_UNNEST_ARRAY_PATTERN = r"SELECT\s+unnest\s*\(\s*ARRAY\s*\[(.*?)\]\s*\)\s+(\w+)"
+# Array elements: runs of quoted strings and other characters up to the next comma outside quotes
+_ARRAY_ELEMENT = re.compile(r"(?:'[^']*'|\"[^\"]*\"|[^,'\"])+")
+# FROM generate_series(start, end, [step]) AS s(a)
+_GENERATE_SERIES_PATTERN = r"FROM\s+generate_series\s*\(\s*([^,]+)\s*,\s*([^,]+)\s*(?:,\s*([^\)]+))?\)\s+AS\s+(\w+)\s*\((\w+)\)"
+# Both in one alternation: groups 1-2 are the unnest groups, groups 3-7 the generate_series groups
+_UNNEST_OR_GENERATE_SERIES = _compile_linear(f"{_UNNEST_ARRAY_PATTERN}|{_GENERATE_SERIES_PATTERN}", re.DOTALL | re.IGNORECASE)
+# Case-insensitive probes that avoid a lowercased copy of the SQL
+_CROSSTAB_PROBE = re.compile(r'crosstab', re.IGNORECASE)
+_UNNEST_OR_GENERATE_SERIES_PROBE = re.compile(r'unnest|generate_series', re.IGNORECASE)
+
+
 # ---- Custom Dialect Definition ----
 class FixedSnowflake(Snowflake):
     class Generator(Snowflake.Generator):
@@ -73,7 +115,7 @@ class FixedSnowflake(Snowflake):
                     step = "1"
 
                 # Detect INTERVAL steps
-                interval_match = re.search(r"INTERVAL\s+'(\d+)\s+(\w+)'", step, re.IGNORECASE)
+                interval_match = _INTERVAL.search(step)
 
                 if interval_match:
                     # ---- DATE SERIES ----
@@ -103,93 +145,123 @@ class FixedSnowflake(Snowflake):
             return super().function_sql(expression)
 
 
+# Dialect, tokenizer, parser and generator instances are reused for every conversion instead of being
+# looked up/built per call. They reset their state per call but are not thread-safe; conversions run
+# in separate processes.
+_PG_DIALECT = sqlglot.Dialect.get_or_raise("postgres")
+_PG_TOKENIZER = _PG_DIALECT.tokenizer()
+_PG_PARSER = _PG_DIALECT.parser()
+_SF_DIALECT = FixedSnowflake()
+_SF_GENERATOR = _SF_DIALECT.generator(pretty=True)
+
+
+def parse_postgres(sql: str) -> exp.Expr:
+    """Parse PostgreSQL into a syntax tree, like sqlglot.parse_one(sql, read="postgres")."""
+    result = _PG_PARSER.parse(_PG_TOKENIZER.tokenize(sql), sql)
+    if not result or result[0] is None:
+        raise ParseError(f"No expression was parsed from '{sql}'")
+    return exp.Block(expressions=result) if len(result) > 1 else result[0]
+
+
+@functools.lru_cache(maxsize=4096)
 def convert_postgres_to_snowflake(sql: str) -> str:
-    """Convert SQL from PostgreSQL to Snowflake dialect using sqlglot."""
+    """Convert SQL from PostgreSQL to Snowflake dialect using sqlglot.
+
+    The result only depends on sql, so conversions are cached per process (repeated
+    block includes and boilerplate views are converted once).
+    """
+    # Nothing to parse, sqlglot would only report an error and return sql
+    if not sql.strip():
+        return sql
     try:
         # Pre-process: Handle crosstab function (not supported in Snowflake)
-        if 'crosstab' in sql.lower():
+        if _CROSSTAB_PROBE.search(sql) is not None:
             sql = handle_crosstab(sql)
 
-        # Pre-process: Convert unnest(ARRAY[...]) to SELECT ... FROM VALUES (...)
-        sql = convert_unnest_array_to_values(sql)
-
-        # Pre-process: Convert generate_series to Snowflake-compatible TABLE(GENERATOR(...))
-        sql = convert_generate_series_to_snowflake(sql)
+        # Pre-process in one pass: Convert unnest(ARRAY[...]) to SELECT ... FROM VALUES (...)
+        # and generate_series to Snowflake-compatible TABLE(GENERATOR(...)), only scanned for when present
+        if _UNNEST_OR_GENERATE_SERIES_PROBE.search(sql) is not None:
+            sql = convert_unnest_and_generate_series(sql)
 
         # Parse with PostgreSQL dialect
-        parsed = sqlglot.parse_one(sql, read="postgres")
+        parsed = parse_postgres(sql)
 
-        # Generate with custom Snowflake dialect
-        converted = parsed.sql(dialect=FixedSnowflake, pretty=True)
+        # Generate with custom Snowflake dialect (the tree is not reused, so no copy is needed)
+        converted = _SF_GENERATOR.generate(parsed, copy=False)
 
         return converted
     except Exception as e:
         sys.stderr.write(f"[Error] Failed to convert SQL: {e}\n")
         return sql
 
-def convert_unnest_array_to_values(sql: str) -> str:
-    """
-    Replace SELECT unnest(ARRAY[...]) col with SELECT col FROM (VALUES (...)) AS t(col)
-    Handles both single and multi-line arrays.
-    """
-    pattern = re.compile(r"SELECT\s+unnest\s*\(\s*ARRAY\s*\[(.*?)\]\s*\)\s+(\w+)", re.DOTALL | re.IGNORECASE)
-
-    def repl(match):
-        array_content = match.group(1)
-        col = match.group(2)
-        # Split array elements, handle both quoted and unquoted
-        elements = re.findall(r"'[^']*'|\"[^\"]*\"|\S+", array_content)
-        # Clean up quotes and whitespace, ignore empty
-        values = ",\n    ".join(f"({e.strip()})" for e in elements if e.strip() and e.strip() != '()')
-        return f"SELECT\n    {col}\n  FROM (VALUES\n    {values}\n  ) AS t({col})"
-
-    return pattern.sub(repl, sql)
+def _unnest_to_values(array_content: str, col: str) -> str:
+    """Build the SELECT col FROM (VALUES ...) replacement for one unnest(ARRAY[...]) match."""
+    # Split array elements on commas, only quoted elements can contain a comma themselves
+    if "'" in array_content or '"' in array_content:
+        elements = _ARRAY_ELEMENT.findall(array_content)
+    else:
+        elements = array_content.split(',')
+    # Clean up whitespace, ignore empty
+    stripped = [e.strip() for e in elements]
+    values = ",\n    ".join(f"({e})" for e in stripped if e and e != '()')
+    return f"SELECT\n    {col}\n  FROM (VALUES\n    {values}\n  ) AS t({col})"
 
 def handle_crosstab(sql: str) -> str:
     """
     Replace crosstab block with a dbt-compatible crosstab SQL using parse_crosstab_sql.
     """
 
-    # Remove all -- comments before parsing
-    sql_no_comments = re.sub(r'--[^\n]*', '', sql)
+    # Remove all -- comments before parsing (cut every line at its first --)
+    if '--' in sql:
+        sql_no_comments = '\n'.join(line.partition('--')[0] for line in sql.split('\n'))
+    else:
+        sql_no_comments = sql
     print("Crosstab function detected, converting to dbt-compatible SQL.")
-    print(sql_no_comments)
+    if _DEBUG:
+        print(sql_no_comments)
     try:
         converted_sql = parse_crosstab_sql(sql_no_comments)
-        print("Converted crosstab SQL:")
-        print(converted_sql)
+        if _DEBUG:
+            print("Converted crosstab SQL:")
+            print(converted_sql)
         return converted_sql
     except Exception as e:
         print(f"[WARNING] Error in parse_crosstab_sql: {e}")
         return "{# WARNING: crosstab() block could not be converted, skipped for dbt compile #}"
 
-def convert_generate_series_to_snowflake(sql: str) -> str:
+def _generate_series_to_generator(start: str, end: str, step: str, alias: str, col: str) -> str:
+    """Build the TABLE(GENERATOR(...)) replacement for one generate_series(...) match."""
+    start = start.strip()
+    end = end.strip()
+    alias = alias or "s"
+    col = col or "a"
+    if step:
+        step = step.strip()
+    else:
+        step = "INTERVAL '1 day'"
+    # Detect INTERVAL steps
+    interval_match = _INTERVAL.search(step)
+    if interval_match:
+        step_value = interval_match.group(1)
+        step_unit = interval_match.group(2).upper()
+        rowcount = f"DATEDIFF({step_unit}, {start}, {end}) / {step_value} + 1"
+        return f"FROM TABLE(GENERATOR(ROWCOUNT => {rowcount})) AS g, LATERAL (SELECT DATEADD({step_unit}, SEQ4() * {step_value}, {start}) AS {col}) AS {alias}"
+    else:
+        # Numeric series
+        rowcount = f"(({end}) - ({start})) / ({step}) + 1"
+        return f"FROM TABLE(GENERATOR(ROWCOUNT => {rowcount})) AS g, LATERAL (SELECT ({start}) + SEQ4() * ({step}) AS {col}) AS {alias}"
+
+def convert_unnest_and_generate_series(sql: str) -> str:
     """
-    Replace FROM generate_series(start, end, step) AS s(a)
+    In a single pass, replace SELECT unnest(ARRAY[...]) col with SELECT col FROM (VALUES (...)) AS t(col)
+    (single and multi-line arrays) and FROM generate_series(start, end, step) AS s(a)
     with FROM TABLE(GENERATOR(ROWCOUNT => ...)) AS g, LATERAL (SELECT DATEADD(...) AS a) AS s
-    Handles both date and numeric series.
+    (date and numeric series).
     """
     def repl(match):
-        start = match.group(1).strip()
-        end = match.group(2).strip()
-        step = match.group(3)
-        alias = match.group(4) or "s"
-        col = match.group(5) or "a"
-        if step:
-            step = step.strip()
-        else:
-            step = "INTERVAL '1 day'"
-        # Detect INTERVAL steps
-        interval_match = re.search(r"INTERVAL\s+'(\d+)\s+(\w+)'", step, re.IGNORECASE)
-        if interval_match:
-            step_value = interval_match.group(1)
-            step_unit = interval_match.group(2).upper()
-            rowcount = f"DATEDIFF({step_unit}, {start}, {end}) / {step_value} + 1"
-            return f"FROM TABLE(GENERATOR(ROWCOUNT => {rowcount})) AS g, LATERAL (SELECT DATEADD({step_unit}, SEQ4() * {step_value}, {start}) AS {col}) AS {alias}"
-        else:
-            # Numeric series
-            rowcount = f"(({end}) - ({start})) / ({step}) + 1"
-            return f"FROM TABLE(GENERATOR(ROWCOUNT => {rowcount})) AS g, LATERAL (SELECT ({start}) + SEQ4() * ({step}) AS {col}) AS {alias}"
-    # Regex: FROM generate_series(start, end, [step]) AS s(a)
-    pattern = re.compile(r"FROM\s+generate_series\s*\(\s*([^,]+)\s*,\s*([^,]+)\s*(?:,\s*([^\)]+))?\)\s+AS\s+(\w+)\s*\((\w+)\)", re.IGNORECASE)
-    return pattern.sub(repl, sql)
+        groups = match.groups()
+        if groups[1] is not None:
+            return _unnest_to_values(*groups[:2])
+        return _generate_series_to_generator(*groups[2:])
+
+    return _UNNEST_OR_GENERATE_SERIES.sub(repl, sql)
@@ -1,16 +1,38 @@
 import re
+from pathlib import Path
 from typing import Any, Dict
 import yaml
 
+# libyaml backed loader when PyYAML was built with it, pure Python otherwise
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+_CREATE_MATERIALIZED_VIEW = re.compile(r'CREATE\s+MATERIALIZED\s+VIEW\s+(\w+)', re.IGNORECASE)
+_CREATE_VIEW = re.compile(r'CREATE\s+VIEW\s+(\w+)', re.IGNORECASE)
+# Jinja blocks like {% ... %}
+_JINJA_BLOCK = re.compile(r"{%-?[^%]*%}")
+# SQL query in the queries: section: a - | line, group 1 is every following indented or empty line
+# up to the next - | line or non-indented line (each starting with its newline)
+_QUERY_BLOCK = re.compile(r'^[^\S\n]*- \|[^\n]*((?:\n(?![^\S\n]*- \|)(?:[ \t][^\n]*|(?=\n|\Z)))*)', re.MULTILINE)
+# Query lines are indented by 4 spaces in the PRY file
+_QUERY_INDENT = re.compile(r'^    ', re.MULTILINE)
+# {% include 'blockname.pry' %}
+_INCLUDE = re.compile(r"{%-?\s*include\s+['\"]([\w\-]+)\.pry['\"]\s*%}")
+# Removes invalid folder characters and replaces spaces with underscores in one pass
+_SANITIZE_TABLE = str.maketrans({c: '' for c in '<>:"/\\|?*'} | {' ': '_'})
+_MULTI_UNDERSCORE = re.compile(r'_+')
+
 def extract_view_name_from_query(query: str) -> str:
     """Extract view name from CREATE VIEW or CREATE MATERIALIZED VIEW statement."""
     # Try to match CREATE MATERIALIZED VIEW first
-    match = re.search(r'CREATE\s+MATERIALIZED\s+VIEW\s+(\w+)', query, re.IGNORECASE)
+    match = _CREATE_MATERIALIZED_VIEW.search(query)
     if match:
         return match.group(1)
     
     # Fall back to regular CREATE VIEW
-    match = re.search(r'CREATE\s+VIEW\s+(\w+)', query, re.IGNORECASE)
+    match = _CREATE_VIEW.search(query)
     if match:
         return match.group(1)
     
@@ -26,53 +48,29 @@ def parse_pry_file(content: str) -> Dict[str, Any]:
     if len(queries_split) != 2:
         raise ValueError("Invalid PRY format: 'queries:' section not found")
     # Remove all Jinja blocks from metadata_yaml
-    metadata_yaml = re.sub(r"{%-?[^%]*%}", '', queries_split[0])
+    metadata_yaml = _JINJA_BLOCK.sub('', queries_split[0])
     queries_section = queries_split[1]
     
     # Parse metadata
-    metadata = yaml.safe_load(metadata_yaml)
+    metadata = yaml.load(metadata_yaml, Loader=_SafeLoader)
     
     # Parse SQL queries (they're YAML list items starting with - |)
-    queries = []
-    current_query = []
-    in_query = False
-    
-    for line in queries_section.split('\n'):
-        if line.strip().startswith('- |'):
-            if current_query:
-                queries.append('\n'.join(current_query))
-            current_query = []
-            in_query = True
-        elif in_query:
-            # End query block only if we hit a non-indented line (new YAML key or list item)
-            if line and not line.startswith(' ') and not line.startswith('\t'):
-                # End of query block
-                if current_query:
-                    queries.append('\n'.join(current_query))
-                    current_query = []
-                in_query = False
-            else:
-                # Only remove 4 leading spaces if present, otherwise keep the line as is
-                if line.startswith('    '):
-                    current_query.append(line[4:])
-                else:
-                    current_query.append(line)
-    
-    # Add last query if exists
-    if current_query:
-        queries.append('\n'.join(current_query))
-    
-    metadata['parsed_queries'] = queries
+    metadata['parsed_queries'] = [
+        _QUERY_INDENT.sub('', block[1:]) for block in _QUERY_BLOCK.findall(queries_section) if block
+    ]
     return metadata
 
+def is_block_file(pry_path: Path) -> bool:
+    """Check if a PRY file is in a blocks folder (case-insensitive, anywhere in path)."""
+    # Single substring search instead of walking pry_path.parents
+    return '/blocks/' in '/' + str(pry_path).lower().replace('\\', '/')
+
 def sanitize_folder_name(name: str) -> str:
     """Convert report name to valid folder name."""
-    # Remove or replace invalid folder characters
-    name = re.sub(r'[<>:"/\\|?*]', '', name)
-    # Replace spaces with underscores
-    name = name.replace(' ', '_')
+    # Remove invalid folder characters and replace spaces with underscores
+    name = name.translate(_SANITIZE_TABLE)
     # Remove multiple underscores
-    name = re.sub(r'_+', '_', name)
+    name = _MULTI_UNDERSCORE.sub('_', name)
     # Convert to lowercase for consistency
     name = name.lower().strip('_')
     return name
@@ -80,5 +78,5 @@ def sanitize_folder_name(name: str) -> str:
 def preprocess_sql(sql: str) -> str:
     """Preprocess SQL to handle Jinja includes and other special syntax."""
     # Replace only {% include 'blockname.pry' %} with {{ blockname() }} in SQL queries
-    sql = re.sub(r"{%-?\s*include\s+['\"]([\w\-]+)\.pry['\"]\s*%}", r"{{ \1() }}", sql)
+    sql = _INCLUDE.sub(r"{{ \1() }}", sql)
     return sql
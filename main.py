@@ -1,33 +1,123 @@
+import contextlib
+import functools
+import io
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 import yaml
 import datetime
 from code.functions.dbt_wrapper import convert_pry_to_dbt
+from code.functions.general import is_block_file, parse_pry_file, sanitize_folder_name
 
 
 class TeeLogger:
+    # Buffered text is written to both streams at a newline or once it exceeds this size
+    BUFFER_SIZE = 8192
+
     def __init__(self, log_path):
         self.terminal = sys.stdout
-        self.log = open(log_path, "a", encoding="utf-8")
+        self.log = open(log_path, "a", encoding="utf-8", buffering=1 << 16)
+        self._buffer = []
+        self._buffered = 0
     def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)
+        # print() writes the text and the newline separately, so both end up in one write
+        self._buffer.append(message)
+        self._buffered += len(message)
+        if '\n' in message or self._buffered > self.BUFFER_SIZE:
+            self._write_buffer()
+    def _write_buffer(self):
+        if self._buffer:
+            text = ''.join(self._buffer)
+            self._buffer.clear()
+            self._buffered = 0
+            self.terminal.write(text)
+            self.log.write(text)
     def flush(self):
+        self._write_buffer()
         self.terminal.flush()
         self.log.flush()
 
 
+def _scan_pry_files(directory):
+    """Yield the os.DirEntry of every PRY file below directory, skipping folders that cannot be read."""
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _scan_pry_files(entry.path)
+                elif entry.name.lower().endswith('.pry'):
+                    yield entry
+    except PermissionError:
+        return
+
+
 def find_pry_files(repo_path: Path, ignored_keywords: list) -> list:
     """Find all PRY files in repository, excluding files with ignored keywords in their names."""
+    lowered_keywords = [keyword.lower() for keyword in ignored_keywords]
     pry_files = []
-    for pry_file in repo_path.rglob("*.pry"):
-        if any(keyword.lower() in pry_file.name.lower() for keyword in ignored_keywords):
-            print(f"[SKIPPED] {pry_file.name} (contains ignored keyword)")
+    # Sorted by path, so the processing order (and which file wins a duplicate model name) does not depend on the file system
+    for entry in sorted(_scan_pry_files(repo_path), key=lambda entry: entry.path):
+        name_lower = entry.name.lower()
+        if any(keyword in name_lower for keyword in lowered_keywords):
+            print(f"[SKIPPED] {entry.name} (contains ignored keyword)")
             continue
-        pry_files.append(pry_file)
+        pry_files.append(Path(entry.path))
     return pry_files
 
 
+@functools.lru_cache(maxsize=None)
+def _load_config(config_path: str = "config.yaml") -> dict:
+    """Load the YAML config file once per process."""
+    with open(config_path, "r") as f:
+        return yaml.safe_load(f)
+
+
+# Per worker process state, set once by _init_worker so it is not pickled for every file
+_worker_state = {}
+
+
+def _init_worker(output_dir: Path, config: dict, block_tables: frozenset) -> None:
+    """Store the arguments shared by all regular files in the worker process."""
+    _worker_state.update(output_dir=output_dir, config=config, block_tables=block_tables)
+
+
+def _output_folder(pry_file: Path) -> str:
+    """Return the model folder a regular PRY file writes to (its own path if it cannot be parsed)."""
+    try:
+        metadata = parse_pry_file(pry_file.read_text(encoding='utf-8'))
+        return sanitize_folder_name(metadata.get('name', 'Unknown Report'))
+    except Exception:
+        # Fails again (and is reported) when the file is converted
+        return str(pry_file)
+
+
+def _group_by_output_folder(pry_files: list) -> list:
+    """Group PRY files that write to the same model folder, keeping the order of pry_files."""
+    groups = {}
+    for pry_file in pry_files:
+        groups.setdefault(_output_folder(pry_file), []).append(pry_file)
+    return list(groups.values())
+
+
+def _convert_regular_files(pry_files: list) -> str:
+    """Convert regular PRY files one after another in a worker process and return their printed output.
+
+    The files of one group share a model folder, so converting them in order lets the last one win,
+    as in a serial run. The output is printed by the parent process, so only the parent writes to the TeeLogger.
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        for pry_file in pry_files:
+            try:
+                convert_pry_to_dbt(pry_file, _worker_state['output_dir'], _worker_state['config'],
+                                   block_tables=_worker_state['block_tables'])
+            except Exception as e:
+                print(f"[ERROR] Failed to process {pry_file.name}: {e}")
+    return output.getvalue()
+
+
 def main():
     # Set up logging to both terminal and logs/main.log
     logs_dir = Path("logs")
@@ -43,9 +133,8 @@ def main():
         sys.exit(1)
     
     input_path = Path(sys.argv[1])
-    # Load config
-    with open("config.yaml", "r") as f:
-        config = yaml.safe_load(f)
+    # Load config (workers get it through the pool initializer instead of loading it again)
+    config = _load_config()
     # Get output directory from args or config
     if len(sys.argv) > 2:
         output_dir = Path(sys.argv[2])
@@ -65,8 +154,9 @@ def main():
             sys.exit(0)
         
         # Separate blocks from regular files
-        block_files = [f for f in pry_files if any(p.name.lower() == 'blocks' for p in f.parents)]
-        regular_files = [f for f in pry_files if f not in block_files]
+        block_files, regular_files = [], []
+        for pry_file in pry_files:
+            (block_files if is_block_file(pry_file) else regular_files).append(pry_file)
         
         # First pass: Process all block files and track created tables
         block_tables = set()
@@ -81,14 +171,26 @@ def main():
         
         print(f"\n=== Processing {len(regular_files)} regular files ===")
         # Second pass: Process regular files with knowledge of block tables
-        for pry_file in regular_files:
-            try:
-                convert_pry_to_dbt(pry_file, output_dir, config, block_tables=block_tables)
-            except Exception as e:
-                print(f"[ERROR] Failed to process {pry_file.name}: {e}")
+        # Files that write to different model folders are independent, so those groups are converted in parallel
+        groups = _group_by_output_folder(regular_files)
+        sys.stdout.flush()
+        done = 0
+        try:
+            with ProcessPoolExecutor(initializer=_init_worker,
+                                     initargs=(output_dir, config, frozenset(block_tables))) as executor:
+                for output in executor.map(_convert_regular_files, groups):
+                    print(output, end='')
+                    done += 1
+        except BrokenProcessPool as e:
+            # A worker died (killed, out of memory), the files of the remaining groups were not (all) converted
+            print(f"[ERROR] A worker process stopped unexpectedly, the following files were not (completely) converted: {e}")
+            for group in groups[done:]:
+                for pry_file in group:
+                    print(f"[ERROR] Not converted: {pry_file}")
+            sys.exit(1)
     else:
         print(f"Processing single file: {input_path}")
-        convert_pry_to_dbt(input_path, output_dir)
+        convert_pry_to_dbt(input_path, output_dir, config)
         print(f"\nDone! Models generated in: {output_dir}")
     print(f"\n--- Run finished at {datetime.datetime.now().isoformat()} ---\n")
 